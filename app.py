@@ -1,10 +1,12 @@
 # streamlit_app.py  –  FIRMS Sicilia “Fogos-style”
 import os
 from datetime import datetime, timezone
-from io import StringIO
 
+import diskcache
 import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pacsv
 import requests
 import streamlit as st
 import folium
@@ -19,6 +21,7 @@ SOURCE = "VIIRS_NOAA20_NRT"              # satellite & product
 MAP_KEY = MAP_KEY = st.secrets.get("MAP_KEY", os.getenv("FIRMS_MAP_KEY"))
 CACHE_HOURS = 0.5                        # refresh ogni 30 min
 DAYS = 1                          # dati degli ultimi 24 ore
+MAP_REFRESH_MIN = 10                     # mappa ricostruita al massimo ogni 10 min
 # ──────────────────────────────────────────────────────────────────────
 
 st.set_page_config(
@@ -45,23 +48,70 @@ st.subheader("Mappa interattiva degli hotspot di calore rilevati nelle ultime 24
 # ───── sessione & cache ───────────────────────────────────────────────
 st.session_state.setdefault("api_calls", 0)
 
-@st.cache_data(ttl=CACHE_HOURS * 3600, show_spinner="⏳ Scarico dati FIRMS…")
-def get_firms_df(bbox, days, api_key, source):
+# colonne FIRMS effettivamente usate dall'app, con schema fisso:
+# niente inferenza dei tipi, float32 basta per la mappa, le altre non si parsano
+FIRMS_TYPES = {"latitude": pa.float32(), "longitude": pa.float32(),
+               "bright_ti4": pa.float32(), "scan": pa.float32(), "track": pa.float32(),
+               "frp": pa.float32(), "acq_date": pa.string(), "acq_time": pa.int32(),
+               "satellite": pa.dictionary(pa.int32(), pa.string()),      # → category
+               "confidence": pa.dictionary(pa.int32(), pa.string())}
+
+@st.cache_resource
+def get_session():
+    # connessione HTTP riusata tra un refresh e l'altro
+    return requests.Session()
+
+@st.cache_resource
+def get_disk_cache():
+    # risposte FIRMS su disco: sopravvivono a riavvii e cold start del server
+    return diskcache.Cache(".firms_cache")
+
+CACHE_TTL_S = CACHE_HOURS * 3600
+
+# Le due cache sono in serie (st.cache_data sopra il disco) e condividono la
+# stessa finestra di CACHE_HOURS (`slot`): una risposta su disco vale solo
+# nella finestra in cui è stata scaricata, così i dati mostrati non superano
+# mai CACHE_HOURS di età e FIRMS viene chiamato al massimo una volta a finestra.
+@st.cache_data(ttl=CACHE_TTL_S, show_spinner="⏳ Scarico dati FIRMS…")
+def get_firms_df(bbox, days, api_key, source, slot):
     w, s, e, n = bbox
     url = f"https://firms.modaps.eosdis.nasa.gov/api/area/csv/{api_key}/{source}/{w},{s},{e},{n}/{days}"
-    r = requests.get(url, timeout=60); r.raise_for_status()
-    st.session_state.api_calls += 1
-    df = pd.read_csv(StringIO(r.text))
-    if df.empty or {"acq_date", "acq_time"} - set(df.columns):
+    dc = get_disk_cache()
+    disk_key = (source, bbox, days)    # niente MAP_KEY in chiaro su disco
+    hit = dc.get(disk_key)
+    fetched = hit is None or hit[0] < slot * CACHE_TTL_S
+    if fetched:
+        r = get_session().get(url, timeout=60); r.raise_for_status()
+        st.session_state.api_calls += 1
+        fetched_at, data = datetime.now(timezone.utc).timestamp(), r.content
+    else:
+        fetched_at, data = hit
+    # il parser CSV di Arrow (C++, multi-thread) legge direttamente i byte,
+    # senza passare per una str Python
+    # include_columns: le colonne non elencate non vengono convertite affatto;
+    # quelle assenti (corpo d'errore) arrivano come colonne tutte nulle
+    opts = pacsv.ConvertOptions(column_types=FIRMS_TYPES,
+                                include_columns=list(FIRMS_TYPES),
+                                include_missing_columns=True)
+    try:
+        df = pacsv.read_csv(pa.BufferReader(data), convert_options=opts).to_pandas()
+    except pa.ArrowInvalid:             # es. "Invalid MAP_KEY." o pagina HTML
+        return pd.DataFrame(), url
+    if df.empty or df[["acq_date", "acq_time"]].isna().all().any():
         return pd.DataFrame(), url
-    df["acq_datetime_utc"] = pd.to_datetime(
-        df["acq_date"] + " " + df["acq_time"].astype(str).str.zfill(4),
-        format="%Y-%m-%d %H%M",
-    ).dt.tz_localize("UTC")
+    if fetched:
+        # su disco solo risposte già parsate e valide: un errore non resta in cache
+        dc.set(disk_key, (fetched_at, data), expire=CACHE_TTL_S)
+    # acq_time è HHMM intero: ore/minuti per aritmetica, niente stringhe per riga
+    day  = pd.to_datetime(df["acq_date"], format="%Y-%m-%d", cache=True, utc=True)
+    hhmm = df["acq_time"]                           # già int32 (FIRMS_TYPES)
+    secs = (hhmm // 100) * 3600 + (hhmm % 100) * 60
+    df["acq_datetime_utc"] = day + pd.to_timedelta(secs, unit="s")
     df["acq_datetime_local"] = df["acq_datetime_utc"].dt.tz_convert("Europe/Rome")
     return df, url
 
-df, url_used = get_firms_df(BBOX, DAYS, MAP_KEY, SOURCE)
+df, url_used = get_firms_df(BBOX, DAYS, MAP_KEY, SOURCE,
+                            int(datetime.now(timezone.utc).timestamp() // CACHE_TTL_S))
 
 if df.empty:
     st.warning("Nessun hotspot o MAP_KEY errata – amplia l'intervallo o verifica la chiave.")
@@ -69,83 +119,103 @@ if df.empty:
 
 
 # ───── funzioni colore & raggio ───────────────────────────────────────
-def color_by_age(ts):
-    hrs = (datetime.now(timezone.utc) - ts).total_seconds() / 3600
-    if hrs <= 6:
-        return "red"
-    elif hrs <= 12:
-        return "orange"
-    elif hrs <= 36:
-        return "yellow"
-    else:
-        return "gray"
-
-def icon_by_stage(frp, brightness):
-    """Return Font Awesome icon name based on FRP and brightness."""
-    if frp >= 50 or brightness >= 367:
-        return "fire"  # fiamma viva
-    elif frp >= 10:
-        return "triangle-exclamation"  # materiale rovente
-    elif frp > 0 or brightness >= 330:
-        return "temperature-high"  # calore residuo
-    else:
-        return None  # nessuna icona
-
-def icon_size_by_scan_track(scan, track):
-    """Return (width, height) for the marker based on scan/track."""
-    avg = (scan + track) / 2
-    if avg >= 0.006:
-        return (35, 35)      # grande
-    if avg >= 0.003:
-        return (25, 25)      # medio
-    return (15, 15)          # piccolo
-
-def radius_by_intensity(row):
-    b_norm  = np.clip((row["bright_ti4"] - 300) / 100, 0, 1)       # 300-400 K
-    frp_norm= np.clip(row["frp"] / 50, 0, 1)                       # 0-50 MW
-    fp_norm = np.clip(((row["scan"] + row["track"]) / 2) / 0.005, 0, 1)
-    score   = (b_norm + frp_norm + fp_norm) / 3
-    return 6 + score * 14   # raggio 6-20 px
+STROKE_COLORS = np.array(["red", "orange", "gray"])
+
+def age_hours(ts, now):
+    """Return the age in hours of every timestamp, as input for stroke_by_age."""
+    return (now - ts).dt.total_seconds().to_numpy(np.float32) / 3600
 
 # ───── MAPPA Folium migliorata ----------------------------------------
 
 import branca.colormap as cm
 
-center = [(BBOX[1]+BBOX[3])/2, (BBOX[0]+BBOX[2])/2]
-m = folium.Map(location=center, zoom_start=7, tiles="CartoDB Positron")
-
 # Colormap continua per FRP
 colormap = cm.linear.YlOrRd_09.scale(0, 100)
 colormap.caption = "FRP – Fire Radiative Power (MW)"
 
 # Funzione colore bordo = età
-def stroke_by_age(ts):
-    hrs = (datetime.now(timezone.utc) - ts).total_seconds() / 3600
-    return "red" if hrs <= 6 else "orange" if hrs <= 12 else "gray"
+def stroke_by_age(hrs):
+    return STROKE_COLORS[np.digitize(hrs, [6, 12], right=True)]
 
 # Funzione raggio
-def radius_by_intensity(row):
-    base = np.clip(row["frp"] / 10, 0.5, 10)
+def radius_by_intensity(df):
+    base = np.clip(df["frp"].to_numpy() / 10, 0.5, 10)
     return base + 5  # range: 5–15 px
 
-for _, r in df.iterrows():
-    folium.CircleMarker(
-        location=[r["latitude"], r["longitude"]],
-        radius=radius_by_intensity(r),
-        color=stroke_by_age(r['acq_datetime_utc']),
-        fill=True,
-        fill_color=colormap(r['frp']),
-        fill_opacity=0.8,
-        weight=1,
-        tooltip=f"FRP {r['frp']:.1f} MW • {r['acq_datetime_local']:%H:%M}",
-        popup=folium.Popup(f"""
-        <b>🔥 Intensità:</b> {r['frp']:.1f} MW<br>
-        <b>🌡 Temperatura:</b> {r['bright_ti4']} K<br>
-        <b>🛰 Satellite:</b> {r['satellite']}<br>
-        <b>🕓 Rilevato:</b> {r['acq_datetime_local']:%d/%m %H:%M}<br>
-        <b>🎯 Confidenza:</b> {r['confidence']}
-        """, max_width=250)
+# Template di tooltip e popup: il formato è analizzato una volta sola
+TOOLTIP_TEMPLATE = "FRP {:.1f} MW • {}".format
+POPUP_TEMPLATE = ("<b>🔥 Intensità:</b> {:.1f} MW<br>"
+                  "<b>🌡 Temperatura:</b> {} K<br>"
+                  "<b>🛰 Satellite:</b> {}<br>"
+                  "<b>🕓 Rilevato:</b> {}<br>"
+                  "<b>🎯 Confidenza:</b> {}").format
+
+# Applicato da Leaflet a ogni CircleMarker del layer GeoJSON
+FEATURE_STYLE_JS = folium.JsCode("""
+function (feature, layer) {
+    layer.setStyle({radius: feature.properties.radius,
+                    color: feature.properties.stroke,
+                    fillColor: feature.properties.fill});
+}
+""")
+
+# Gli hotspot cambiano solo se cambiano i dati o la fascia d'età dei punti:
+# i rerun dovuti a click/interazioni riusano le feature già calcolate.
+# Si mette in cache il GeoJSON (st.cache_data ne restituisce una copia a ogni
+# chiamata), non la folium.Map: st_folium la modifica e non va condivisa.
+@st.cache_data(ttl=MAP_REFRESH_MIN * 60)
+def build_features(df, now_bucket, _now):
+    # raggi e colori calcolati una volta su tutte le colonne, non riga per riga
+    radii   = radius_by_intensity(df)
+    strokes = stroke_by_age(age_hours(df["acq_datetime_utc"], _now))
+
+    # tooltip e popup: template già pronti applicati in un solo passaggio sugli array
+    frp_mw   = df["frp"].to_numpy()
+    local    = df["acq_datetime_local"].dt
+    tooltips = np.frompyfunc(TOOLTIP_TEMPLATE, 2, 1)(frp_mw, local.strftime("%H:%M").to_numpy())
+    popups   = np.frompyfunc(POPUP_TEMPLATE, 5, 1)(
+        frp_mw,
+        df["bright_ti4"].to_numpy().astype(str),      # repr float32, es. "331.45"
+        df["satellite"].to_numpy(),
+        local.strftime("%d/%m %H:%M").to_numpy(),
+        df["confidence"].to_numpy(),
+    )
+
+    # solo le colonne che servono, iterate come tuple semplici (niente Series per riga)
+    pts = df.assign(radius=radii, stroke=strokes, tooltip=tooltips, popup=popups)[
+        ["latitude", "longitude", "radius", "stroke", "frp", "tooltip", "popup"]]
+
+    # un'unica FeatureCollection GeoJSON: un solo layer e un solo render,
+    # invece di un CircleMarker (e un template Jinja) per hotspot
+    features = [
+        {"type": "Feature", "id": i,
+         "geometry": {"type": "Point", "coordinates": [lon, lat]},
+         "properties": {"radius": radius, "stroke": stroke, "fill": colormap(frp),
+                        "tooltip": tooltip, "popup": popup}}
+        for i, (lat, lon, radius, stroke, frp, tooltip, popup)
+        in enumerate(pts.itertuples(index=False, name=None))
+    ]
+    return {"type": "FeatureCollection", "features": features}
+
+# La folium.Map invece si ricostruisce a ogni run (costa poco: un solo layer)
+def build_map(features):
+    center = [(BBOX[1]+BBOX[3])/2, (BBOX[0]+BBOX[2])/2]
+    # prefer_canvas: i CircleMarker sono disegnati su un unico <canvas>
+    # invece di un nodo SVG per hotspot (regge migliaia di punti)
+    m = folium.Map(location=center, zoom_start=7, tiles="CartoDB Positron", prefer_canvas=True)
+    folium.GeoJson(
+        features,
+        marker=folium.CircleMarker(fill=True, fill_opacity=0.8, weight=1),
+        # stile letto da feature.properties nel browser: niente style_function
+        # Python valutata per feature e serializzata in uno switch JS
+        on_each_feature=FEATURE_STYLE_JS,
+        tooltip=folium.GeoJsonTooltip(fields=["tooltip"], labels=False),
+        popup=folium.GeoJsonPopup(fields=["popup"], labels=False, max_width=250),
     ).add_to(m)
+    return m
+
+now = datetime.now(timezone.utc)     # unico "adesso" per tutto il render
+m = build_map(build_features(df, int(now.timestamp() // (MAP_REFRESH_MIN * 60)), now))
 
 # ───── slider giorni & spiegazione dataset ───────────────────────────
 
@@ -194,14 +264,19 @@ Clicca su un punto per vedere i dettagli tecnici dell’osservazione (FRP, tempe
     )
 
 # ───── controllo click & dettagli (uguale) ----------------------------
-map_state = st_folium(m, use_container_width=True, key="map")
-clicked = map_state.get("last_object_clicked")
-if clicked:
-    lat_c, lon_c = round(clicked["lat"], 5), round(clicked["lng"], 5)
-    sel = df[(df["latitude"].round(5)==lat_c) & (df["longitude"].round(5)==lon_c)]
-    if not sel.empty:
-        r = sel.iloc[0]
-        details = pd.DataFrame({
+# solo i click fanno ripartire lo script, non pan/zoom della mappa;
+# last_active_drawing è la feature GeoJSON cliccata (con il suo id)
+map_state = st_folium(m, use_container_width=True, key="map",
+                      returned_objects=["last_active_drawing"])
+clicked = map_state.get("last_active_drawing")
+if clicked and clicked.get("id") is not None:
+    # l'id della feature è la posizione della riga in df (vedi build_features):
+    # niente confronto di coordinate, che per i marker grandi sono quelle del mouse
+    idx = int(clicked["id"])
+    if 0 <= idx < len(df):
+        r = df.iloc[idx]
+        # st.table accetta direttamente un dict: niente DataFrame per 16 celle
+        details = {
             "Campo": ["FRP (MW)", "Brightness (K)", "Scan °", "Track °",
                       "Satellite", "Confidenza", "UTC", "Locale"],
             "Valore": [f"{r['frp']:.1f}", r["bright_ti4"],
@@ -209,7 +284,7 @@ if clicked:
                        r["satellite"], r["confidence"],
                        r["acq_datetime_utc"].strftime("%Y-%m-%d %H:%M"),
                        r["acq_datetime_local"].strftime("%d/%m %H:%M")]
-        })
+        }
         st.sidebar.subheader("Dettagli hotspot selezionato")
         st.sidebar.table(details)
 